@@ -0,0 +1,363 @@
+import logging
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pydicom
+from pydicom.dataelem import RawDataElement
+from pydicom.filebase import DicomBytesIO
+from pydicom.filewriter import dcmwrite, write_dataset
+from pydicom.multival import MultiValue
+from pydicom.tag import BaseTag
+from pydicom.uid import DeflatedExplicitVRLittleEndian, generate_uid
+
+# Setup basic logging to console
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+logger = logging.getLogger(__name__)
+
+# DICOM_ANON_QUIET=1 drops the per-file INFO messages. Worker processes
+# inherit the environment, so this applies to them as well.
+if os.environ.get("DICOM_ANON_QUIET") == "1":
+    logger.setLevel(logging.WARNING)
+
+# A list of tags to anonymize, based on DICOM PS3.15, Annex E.
+TAGS_TO_ANONYMIZE_BY_GROUP = {
+    "Patient Information": [
+        (0x0010, 0x0010),  # Patient's Name
+        (0x0010, 0x0020),  # Patient ID
+        (0x0010, 0x0021),  # Issuer of Patient ID
+        (0x0010, 0x0030),  # Patient's Birth Date
+        (0x0010, 0x0032),  # Patient's Birth Time
+        (0x0010, 0x0040),  # Patient's Sex
+        (0x0010, 0x1000),  # Other Patient IDs
+        (0x0010, 0x1001),  # Other Patient Names
+        (0x0010, 0x1002),  # Other Patient IDs Sequence
+        (0x0010, 0x1010),  # Patient's Age
+        (0x0010, 0x1020),  # Patient's Size
+        (0x0010, 0x1030),  # Patient's Weight
+        (0x0010, 0x1040),  # Patient's Address
+        (0x0010, 0x2160),  # Ethnic Group
+        (0x0010, 0x2180),  # Occupation
+        (0x0010, 0x21B0),  # Additional Patient History
+        (0x0010, 0x4000),  # Patient Comments
+    ],
+    "Physician Information": [
+        (0x0008, 0x0080),  # Institution Name
+        (0x0008, 0x0081),  # Institution Address
+        (0x0008, 0x0090),  # Referring Physician's Name
+        (0x0008, 0x0092),  # Referring Physician's Address
+        (0x0008, 0x0094),  # Referring Physician's Telephone Numbers
+        (0x0008, 0x1050),  # Performing Physician's Name
+        (0x0008, 0x1070),  # Operators' Name
+    ],
+    "Study Information": [
+        (0x0008, 0x1030),  # Study Description
+        (0x0008, 0x0050),  # Accession Number
+        (0x0032, 0x1032),  # Requesting Physician
+    ],
+    "Equipment Information": [(0x0008, 0x1010)],  # Station Name
+    "UIDs": [
+        (0x0020, 0x000D),  # Study Instance UID
+        (0x0020, 0x000E),  # Series Instance UID
+        (0x0008, 0x0018),  # SOP Instance UID
+        (0x0020, 0x0052),  # Frame of Reference UID
+    ],
+}
+
+# A flattened list of all tags for easier processing
+ALL_TAGS_TO_ANONYMIZE = [
+    tag for group_tags in TAGS_TO_ANONYMIZE_BY_GROUP.values() for tag in group_tags
+]
+
+# The same tags as pydicom BaseTag ints. pydicom uses these as dataset keys
+# directly, skipping the tuple-to-tag conversion on every lookup.
+INT_TAGS = [
+    BaseTag((group << 16) | element) for group, element in ALL_TAGS_TO_ANONYMIZE
+]
+
+# Dictionary VR of each tag, precomputed so the per-file loop does not need to
+# look it up on the dataset element.
+TAG_VR_MAP = {tag: pydicom.datadict.dictionary_VR(tag) for tag in INT_TAGS}
+
+# Replacement UIDs by (salt, original UID). Every file that references the same
+# study, series or frame of reference gets the same new UID, so the links
+# between files survive anonymization.
+_uid_map = {}
+
+# Salt used when the caller does not pass one. Random per process, so runs
+# spread over several processes must share an explicit uid_salt instead.
+_PROCESS_UID_SALT = generate_uid()
+
+
+def _replacement_uid(original_uid, uid_salt):
+    """
+    Returns the new UID for original_uid. The UID is derived from the salt and
+    the original value, so worker processes agree on it without sharing state.
+    """
+    key = (uid_salt, original_uid)
+    new_uid = _uid_map.get(key)
+    if new_uid is None:
+        new_uid = _uid_map[key] = generate_uid(entropy_srcs=[uid_salt, original_uid])
+    return new_uid
+
+
+# Replacement value for each VR. Callables receive the original value and the
+# UID salt. VRs not listed here are blanked.
+VR_REPLACEMENT = {
+    "UI": _replacement_uid,
+    "PN": "ANONYMIZED",
+    "SH": "ANONYMIZED",
+    "LO": "ANONYMIZED",
+    "ST": "ANONYMIZED",
+    "LT": "ANONYMIZED",
+    "DA": "18000101",
+    "TM": "000000",
+    "DS": "0",
+    "IS": "0",
+}
+_BLANK = ""
+
+PIXEL_DATA_TAG = BaseTag(0x7FE00010)
+
+# Datasets with fewer top-level elements than this find their private tags
+# with a plain loop, as building a NumPy array would cost more than it saves
+PRIVATE_TAG_VECTORIZE_MIN = 32
+
+# Bytes copied from the source file per read when splicing in PixelData
+COPY_CHUNK_SIZE = 1 << 20
+
+
+def anonymize_dicom_file(
+    input_path, output_path, tags_to_anonymize, deep_private=False, uid_salt=None
+):
+    """
+    Anonymizes a single DICOM file by removing or replacing specific tags.
+    tags_to_anonymize holds int tags, as in INT_TAGS. Private tags are removed
+    from the top level only, unless deep_private also asks for those nested
+    inside sequences. Files anonymized with the same uid_salt map each original
+    UID to the same new UID.
+    Returns True on success, False on failure.
+    """
+    with open(input_path, "rb", buffering=65536) as f:
+        # DICOM files have "DICM" after a 128-byte preamble. dcmread rejects
+        # files without it anyway, so skip those before any parsing.
+        f.seek(128)
+        is_dicom = f.read(4) == b"DICM"
+        if is_dicom:
+            f.seek(0)
+            try:
+                # Values larger than 1 KB (e.g. PixelData) are left unread;
+                # pydicom fetches them from input_path again only when the
+                # file is saved.
+                ds = pydicom.dcmread(f, defer_size="1 KB", force=False)
+            except pydicom.errors.InvalidDicomError:
+                is_dicom = False
+
+    if not is_dicom:
+        logger.warning("Skipping non-DICOM file: %s", input_path)
+        return False
+
+    # Anonymize specific tags. Replacements are staged first and written back
+    # in one pass by _apply_updates. get_item leaves untouched elements raw, so
+    # their original values are never decoded.
+    updates = {}
+    for tag in tags_to_anonymize:
+        elem = ds.get_item(tag)
+        if elem is None:
+            continue
+        vr = TAG_VR_MAP[tag]
+        replacement = VR_REPLACEMENT.get(vr, _BLANK)
+        if callable(replacement):
+            replacement = replacement(
+                _original_text(elem), uid_salt or _PROCESS_UID_SALT
+            )
+        updates[tag] = (vr, replacement)
+    _apply_updates(ds, updates)
+
+    # Remove private tags (odd group number). The recursive removal is also
+    # used when raw elements must be converted before saving, as it converts
+    # every element it visits.
+    if deep_private or _has_vr_less_raw_elements(ds):
+        ds.remove_private_tags()
+    else:
+        if len(ds) < PRIVATE_TAG_VECTORIZE_MIN:
+            private_tags = [tag for tag in ds.keys() if (tag >> 16) & 1]
+        else:
+            # Classify every tag's group parity in one array operation
+            keys = np.fromiter(ds.keys(), dtype=np.uint32, count=len(ds))
+            private_tags = keys[(keys >> 16) & 1 == 1].tolist()
+        for tag in private_tags:
+            del ds[tag]
+
+    # Update file meta information with the new SOP Instance UID
+    if (0x0002, 0x0003) in ds.file_meta:
+        ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+
+    # Save the anonymized file in its original encoding, copying PixelData
+    # straight from the source file where possible
+    if not _save_with_pixel_copy(ds, input_path, output_path):
+        ds.save_as(output_path, enforce_file_format=False)
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("Anonymized '%s' -> '%s'", input_path, output_path)
+    return True
+
+
+def _has_vr_less_raw_elements(ds):
+    """
+    Returns True if ds was read as explicit VR but holds raw elements without
+    a VR. This happens when the transfer syntax of a file does not match its
+    actual encoding, and such elements cannot be saved until converted.
+    """
+    if ds.original_encoding[0] is not False:
+        return False
+    return any(ds.get_item(tag, keep_deferred=True).VR is None for tag in ds.keys())
+
+
+def _original_text(elem):
+    """
+    Returns the value of elem as text, decoding it if elem is still raw.
+    Multiple values are joined with backslashes, as they are stored in the
+    file, so the result can always be used as a dict key.
+    """
+    if elem.is_raw:
+        return (elem.value or b"").rstrip(b"\x00 ").decode("ascii", "replace")
+    if isinstance(elem.value, MultiValue):
+        return "\\".join(elem.value)
+    return elem.value
+
+
+def _apply_updates(ds, updates):
+    """
+    Writes staged replacements into ds as pre-encoded raw elements, which
+    pydicom writes out as-is, skipping value conversion and validation.
+    updates maps int tag to (VR, replacement text); every replacement is an
+    ASCII constant or a pydicom-generated UID.
+    """
+    is_implicit_vr, is_little_endian = ds.original_encoding
+    for tag, (vr, value) in updates.items():
+        encoded = value.encode("ascii")
+        # Values must have even length: UIDs are padded with NUL, text with space
+        if len(encoded) % 2:
+            encoded += b"\x00" if vr == "UI" else b" "
+        ds[tag] = RawDataElement(
+            tag, vr, len(encoded), encoded, 0, is_implicit_vr, is_little_endian
+        )
+
+
+def _save_with_pixel_copy(ds, input_path, output_path):
+    """
+    Saves ds like ds.save_as, but copies the PixelData element byte-for-byte
+    from input_path instead of reading it into memory and encoding it again.
+    Only native (defined length) PixelData that was deferred on read is
+    handled. Returns False without writing anything otherwise, so the caller
+    can fall back to ds.save_as.
+    """
+    pixel_elem = ds.get_item(PIXEL_DATA_TAG, keep_deferred=True)
+    if (
+        not isinstance(pixel_elem, RawDataElement)
+        or pixel_elem.value is not None
+        or pixel_elem.length == 0xFFFFFFFF
+        or ds.file_meta.get("TransferSyntaxUID") == DeflatedExplicitVRLittleEndian
+        # Truncated PixelData is left to ds.save_as
+        or pixel_elem.value_tell + pixel_elem.length > os.path.getsize(input_path)
+    ):
+        return False
+
+    # Encode the preamble, file meta and every element before PixelData
+    head = ds[:PIXEL_DATA_TAG]
+    head.file_meta = ds.file_meta
+    head.preamble = ds.preamble
+    header = DicomBytesIO()
+    dcmwrite(header, head, enforce_file_format=False)
+
+    # The copied element header is only valid if the encoding is unchanged
+    if (header.is_implicit_VR, header.is_little_endian) != (
+        pixel_elem.is_implicit_VR,
+        pixel_elem.is_little_endian,
+    ):
+        return False
+
+    # Encode any elements after PixelData, such as trailing padding
+    footer = DicomBytesIO()
+    footer.is_implicit_VR = header.is_implicit_VR
+    footer.is_little_endian = header.is_little_endian
+    write_dataset(footer, ds[PIXEL_DATA_TAG + 1 :], ds.original_character_set)
+
+    # Tag and length, plus VR and reserved bytes for explicit VR (OB/OW)
+    elem_header_size = 8 if pixel_elem.is_implicit_VR else 12
+    remaining = elem_header_size + pixel_elem.length
+    with open(input_path, "rb") as src, open(output_path, "wb") as dst:
+        dst.write(header.getvalue())
+        src.seek(pixel_elem.value_tell - elem_header_size)
+        while remaining:
+            chunk = src.read(min(remaining, COPY_CHUNK_SIZE))
+            if not chunk:
+                break
+            dst.write(chunk)
+            remaining -= len(chunk)
+        else:
+            dst.write(footer.getvalue())
+
+    if remaining:
+        # The source shrank since it was read; never leave a partial output
+        os.remove(output_path)
+        return False
+
+    return True
+
+
+def _worker(job):
+    """
+    Pool entry point: unpacks a (input_path, output_path, tags_to_anonymize,
+    deep_private, uid_salt) job tuple and anonymizes that file. It lives here,
+    not in the Streamlit script, so spawned workers never import Streamlit.
+    """
+    return anonymize_dicom_file(*job)
+
+
+def fast_walk(root, skip_prefix, max_workers=16):
+    """
+    Recursively lists all files under root, skipping any subtree whose path
+    starts with skip_prefix. Subdirectories are enumerated concurrently with
+    os.scandir, which overlaps directory reads on slow or network filesystems.
+    """
+    pending_dirs = queue.Queue()
+    pending_dirs.put(root)
+    files = []
+    files_lock = threading.Lock()
+
+    def scan_worker():
+        while True:
+            directory = pending_dirs.get()
+            if directory is None:
+                return
+            found = []
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        # scandir caches the entry type, so no extra stat call
+                        if entry.is_dir(follow_symlinks=False):
+                            if not entry.path.startswith(skip_prefix):
+                                pending_dirs.put(entry.path)
+                        elif entry.is_file():
+                            found.append(entry.path)
+            except OSError as e:
+                logger.warning("Could not scan directory %s: %s", directory, e)
+            finally:
+                with files_lock:
+                    files.extend(found)
+                pending_dirs.task_done()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for _ in range(max_workers):
+            executor.submit(scan_worker)
+        # Wait until every queued directory has been scanned, then stop workers
+        pending_dirs.join()
+        for _ in range(max_workers):
+            pending_dirs.put(None)
+
+    return files